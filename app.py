@@ -1,24 +1,22 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib.font_manager as fm
-import os
 import io
-from PIL import Image
+import hashlib
 
-# ===== フォント設定 =====
-jp_font = None
+import report
 
+# ===== フォント設定 =====
+# フォントはプロセス内で1度だけ登録し、以降はrcParamsのファミリー名で解決させる
+@st.cache_resource
 def set_japanese_font():
-    global jp_font
-    font_path = os.path.join(os.path.dirname(__file__), "ipaexg.ttf")
-    if os.path.exists(font_path):
-        jp_font = fm.FontProperties(fname=font_path)
-        plt.rcParams["font.family"] = jp_font.get_name()
-    else:
-        st.warning("日本語フォントが見つかりません。PDF出力で文字化けする可能性があります。")
+    if report.register_font():
+        return True
+    st.warning("日本語フォントが見つかりません。PDF出力で文字化けする可能性があります。")
+    return False
 
 set_japanese_font()
 
@@ -59,84 +57,105 @@ graph_descriptions = {
     "土壌水分 vs 地温": "土壌環境の水と熱の関係性を示します。"
 }
 
-# ===== PDF保存用関数 =====
-def save_fig_as_image_to_pdf(fig, pdf):
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png", dpi=300, bbox_inches="tight")
-    buf.seek(0)
-    img = Image.open(buf)
-    fig_img, ax_img = plt.subplots(figsize=(8, 6))
-    ax_img.axis("off")
-    ax_img.imshow(img)
-    pdf.savefig(fig_img)
-    plt.close(fig_img)
-    buf.close()
-
-# ===== 共通描画関数 =====
-def plot_line(x, y, title, xlabel, ylabel, pdf, color="blue", linewidth=0.8, ideal_range=None):
-    if title in graph_descriptions:
-        st.markdown(f"**{graph_descriptions[title]}**")
-    fig, ax = plt.subplots()
-    ax.plot(x, y, color=color, linewidth=linewidth, label="data")
-    if ideal_range:
-        ax.axhspan(ideal_range[0], ideal_range[1], color=color, alpha=0.1, label="ideal_range")
-    ax.set_title(title, fontproperties=jp_font)
-    ax.set_xlabel(xlabel, fontproperties=jp_font)
-    ax.set_ylabel(ylabel, fontproperties=jp_font)
-    ax.legend()
-    plt.setp(ax.get_xticklabels(), rotation=90)
-    st.pyplot(fig)
-    save_fig_as_image_to_pdf(fig, pdf)
-    plt.close(fig)
+# ===== グラフ設定 =====
+# 派生指標の時系列: (列名, タイトル, 縦軸ラベル, 色, 理想範囲)
+LINE_STYLES = (
+    ("temp_diff", "温度と地温の乖離", "気温 - 地温 (°C)", "red", None),
+    ("temp_sum", "気温と地温の合計", "気温 + 地温 (°C)", "purple", None),
+    ("soil_moisture_diff_abs", "潅水後の保水持続性（絶対変化量）", "水分変化 (%)", "brown", None),
+    ("soil_moisture_1st_deriv", "水分減少速度（一次微分）", "水分微分値", "blue", None),
+    ("dry_streak", "連続乾燥時間カウント", "連続乾燥時間 (回)", "orange", None),
+    ("soil_temp_range", "地温の日内変動幅", "日内変動幅 (°C)", "green", None),
+)
+# 散布図: (横軸の列, 縦軸の列, タイトル, 横軸ラベル, 縦軸ラベル)
+SCATTER_STYLES = (
+    ("temperature", "humidity", "温度 vs 湿度", "温度", "湿度"),
+    ("underground_water_content", "underground_temperature", "土壌水分 vs 地温", "水分", "地温"),
+)
+
+# ===== 画面表示（PDFは report.build_pdf で生成） =====
+def show_plot(ax, spec):
+    if spec["title"] in graph_descriptions:
+        st.markdown(f"**{graph_descriptions[spec['title']]}**")
+    report.draw(ax, spec)
+    st.pyplot(ax.figure)
+
+# ===== CSV読み込み（アップロードごとに1回だけ解析） =====
+@st.cache_data(max_entries=4)
+def load_csv(file_bytes):
+    # 列が無い場合にparse_datesがエラーにならないよう、先にヘッダーだけ確認する
+    header = pd.read_csv(io.BytesIO(file_bytes), nrows=0).columns
+    parse_dates = ["terminal_date"] if "terminal_date" in header else False
+    df = pd.read_csv(io.BytesIO(file_bytes), engine="pyarrow", parse_dates=parse_dates)
+    if "terminal_date" in df.columns:
+        # parse_datesで変換できなかった形式のみここで変換する
+        if not pd.api.types.is_datetime64_any_dtype(df["terminal_date"]):
+            df["terminal_date"] = pd.to_datetime(df["terminal_date"])
+        df = df.sort_values("terminal_date", kind="mergesort").reset_index(drop=True)
+    return df
+
+# ===== 連続カウント（Trueが続いた回数、Falseで0にリセット） =====
+def run_length(mask):
+    idx = np.arange(len(mask))
+    last_reset = np.maximum.accumulate(np.where(mask, -1, idx))
+    return idx - last_reset
+
+# ===== 派生指標の計算（同じ条件での再実行時はキャッシュを利用） =====
+# 大きなDataFrameは一部の行だけでハッシュされ内容の違いを見逃すため、
+# キャッシュキーにはDataFrame(_df)ではなくアップロードされたファイルのダイジェストを使う
+@st.cache_data(max_entries=16)
+def compute_metrics(_df, file_digest, start_date, end_date, ideal_ranges):
+    ideal_ranges = dict(ideal_ranges)
+    # terminal_dateは読み込み時にソート済みなので二分探索で期間を切り出す
+    ts = _df["terminal_date"].to_numpy()
+    lo = np.searchsorted(ts, np.datetime64(start_date), side="left")
+    hi = np.searchsorted(ts, np.datetime64(end_date), side="right")
+    df = _df.iloc[lo:hi].copy()
+    if df.empty:
+        return df
 
-def plot_scatter(x, y, title, xlabel, ylabel, pdf):
-    if title in graph_descriptions:
-        st.markdown(f"**{graph_descriptions[title]}**")
-    fig, ax = plt.subplots()
-    ax.scatter(x, y, alpha=0.5, label="scatter")
-    ax.set_title(title, fontproperties=jp_font)
-    ax.set_xlabel(xlabel, fontproperties=jp_font)
-    ax.set_ylabel(ylabel, fontproperties=jp_font)
-    ax.legend()
-    plt.setp(ax.get_xticklabels(), rotation=90)
-    st.pyplot(fig)
-    save_fig_as_image_to_pdf(fig, pdf)
-    plt.close(fig)
+    t = df["temperature"].to_numpy(dtype=float)
+    h = df["humidity"].to_numpy(dtype=float)
+    es = 0.6108 * np.exp(17.27 * t / (t + 237.3))
+    df["VPD"] = es * (1.0 - h / 100.0)
+    df["temp_diff"] = df["temperature"] - df["underground_temperature"]
+    df["temp_sum"] = df["temperature"] + df["underground_temperature"]
+    d = df["underground_water_content"].diff()
+    df["soil_moisture_diff"] = d
+    df["soil_moisture_diff_abs"] = d.abs()
+    df["soil_moisture_1st_deriv"] = d
+    threshold = ideal_ranges["underground_water_content"][0]
+    dry = df["underground_water_content"].to_numpy() < threshold
+    df["dry_count"] = dry.astype(int)
+    df["dry_streak"] = run_length(dry)
+    r = df.rolling("1D", on="terminal_date")["underground_temperature"]
+    df["soil_temp_range"] = r.max() - r.min()
+    cols = list(ideal_ranges)
+    arr = df[cols].to_numpy(dtype=float)
+    lows = np.array([ideal_ranges[c][0] for c in cols], dtype=float)
+    highs = np.array([ideal_ranges[c][1] for c in cols], dtype=float)
+    df["all_ok"] = np.all((arr >= lows) & (arr <= highs), axis=1)
+    return df
 
 # ===== 分析処理 =====
-def analyze_and_plot(df, start_date, end_date):
-    df["terminal_date"] = pd.to_datetime(df["terminal_date"])
-    df = df[(df["terminal_date"] >= start_date) & (df["terminal_date"] <= end_date)].copy()
+def analyze_and_plot(df, file_digest, start_date, end_date):
+    df = compute_metrics(df, file_digest, start_date, end_date, tuple(IDEAL_RANGES.items()))
     if df.empty:
         st.warning("指定期間にデータがありません。")
         return
 
-    df["VPD"] = 0.6108 * np.exp((17.27 * df["temperature"]) / (df["temperature"] + 237.3))
-    df["VPD"] -= df["VPD"] * df["humidity"] / 100
-    df["temp_diff"] = df["temperature"] - df["underground_temperature"]
-    df["temp_sum"] = df["temperature"] + df["underground_temperature"]
-    df["soil_moisture_diff"] = df["underground_water_content"].diff()
-    df["soil_moisture_diff_abs"] = df["soil_moisture_diff"].abs()
-    df["soil_moisture_1st_deriv"] = df["underground_water_content"].diff()
-    threshold = IDEAL_RANGES["underground_water_content"][0]
-    df["dry_count"] = (df["underground_water_content"] < threshold).astype(int)
-    df["dry_streak"] = df["dry_count"].groupby((df["dry_count"] != df["dry_count"].shift()).cumsum()).cumsum()
-    df["soil_temp_range"] = df.set_index("terminal_date")["underground_temperature"].rolling("1D").apply(lambda x: x.max() - x.min()).reset_index(drop=True)
-    df["all_ok"] = True
-    for col, (low, high) in IDEAL_RANGES.items():
-        df["all_ok"] &= (df[col] >= low) & (df[col] <= high)
-
     st.subheader("統計情報")
     cols = list(IDEAL_RANGES.keys())
-    stats = df[cols].describe().loc[["mean", "max", "min", "std"]]
-    st.dataframe(stats.round(2))
+    stats = df[cols].agg(["mean", "max", "min", "std"]).round(2)
+    st.dataframe(stats)
 
     st.subheader("理想範囲に入っている割合")
     col1, col2 = st.columns(2)
     for i, col in enumerate(cols):
         low, high = IDEAL_RANGES[col]
-        total = df[col].notnull().sum()
-        in_range = df[(df[col] >= low) & (df[col] <= high)][col].count()
+        s = df[col]
+        total = s.notna().sum()
+        in_range = s.between(low, high, inclusive="both").sum()
         percent = round(in_range / total * 100, 1) if total else 0
         (col1 if i % 2 == 0 else col2).metric(label=col, value=f"{percent} %")
 
@@ -144,38 +163,45 @@ def analyze_and_plot(df, start_date, end_date):
     percent = round(df["all_ok"].sum() / len(df) * 100, 1)
     st.metric("全項目が理想範囲内の割合", f"{percent} %")
 
-    with PdfPages("output_analysis.pdf") as pdf:
-        plot_line(df["terminal_date"], df["temp_diff"], "温度と地温の乖離", "時刻", "気温 - 地温 (°C)", pdf, color="red")
-        plot_line(df["terminal_date"], df["temp_sum"], "気温と地温の合計", "時刻", "気温 + 地温 (°C)", pdf, color="purple")
-        plot_line(df["terminal_date"], df["soil_moisture_diff_abs"], "潅水後の保水持続性（絶対変化量）", "時刻", "水分変化 (%)", pdf, color="brown")
-        plot_line(df["terminal_date"], df["soil_moisture_1st_deriv"], "水分減少速度（一次微分）", "時刻", "水分微分値", pdf, color="blue")
-        plot_line(df["terminal_date"], df["dry_streak"], "連続乾燥時間カウント", "時刻", "連続乾燥時間 (回)", pdf, color="orange")
-        plot_line(df["terminal_date"], df["soil_temp_range"], "地温の日内変動幅", "時刻", "日内変動幅 (°C)", pdf, color="green")
-
-        for col in IDEAL_RANGES:
-            plot_line(df["terminal_date"], df[col], f"{col} の時間推移", "時刻", col, pdf, color="gray", ideal_range=IDEAL_RANGES[col])
-
-        plot_scatter(df["temperature"], df["humidity"], "温度 vs 湿度", "温度", "湿度", pdf)
-        plot_scatter(df["underground_water_content"], df["underground_temperature"], "土壌水分 vs 地温", "水分", "地温", pdf)
+    # (列名, タイトル, 縦軸ラベル, 色, 理想範囲) 1列につき1グラフ
+    plots_spec = list(LINE_STYLES) + [(col, f"{col} の時間推移", col, "gray", IDEAL_RANGES[col]) for col in IDEAL_RANGES]
+    specs = []
+    x = df["terminal_date"].to_numpy()
+    for y_col, title, ylabel, color, ideal_range in plots_spec:
+        # 間引きは画面表示とPDFで共有するため、ここで1度だけ行う
+        line_x, line_y = report.downsample(x, df[y_col].to_numpy())
+        specs.append({"kind": "line", "x": line_x, "y": line_y, "title": title, "xlabel": "時刻",
+                      "ylabel": ylabel, "color": color, "ideal_range": ideal_range})
+    for x_col, y_col, title, xlabel, ylabel in SCATTER_STYLES:
+        specs.append({"kind": "scatter", "x": df[x_col].to_numpy(), "y": df[y_col].to_numpy(),
+                      "title": title, "xlabel": xlabel, "ylabel": ylabel})
+
+    # 画面表示は1つのFigure/Axesを使い回す
+    fig, ax = plt.subplots()
+    for spec in specs:
+        show_plot(ax, spec)
+    plt.close(fig)
 
-        for x, y in [("temperature", "humidity"), ("underground_water_content", "underground_temperature")]:
-            corr = df[[x, y]].corr().iloc[0, 1].round(3)
-            st.write(f"{x} と {y} の相関係数: {corr}")
+    for x, y in [("temperature", "humidity"), ("underground_water_content", "underground_temperature")]:
+        corr = df[[x, y]].corr().iloc[0, 1].round(3)
+        st.write(f"{x} と {y} の相関係数: {corr}")
 
-    st.success("PDFファイルを保存しました: output_analysis.pdf")
-    with open("output_analysis.pdf", "rb") as f:
-        st.download_button("PDFをダウンロード", f, file_name="output_analysis.pdf", mime="application/pdf")
+    buf = io.BytesIO()
+    report.build_pdf(specs, buf)
+    st.success("PDFファイルを作成しました: output_analysis.pdf")
+    st.download_button("PDFをダウンロード", buf.getvalue(), file_name="output_analysis.pdf", mime="application/pdf")
 
 # ===== Streamlit UI =====
 st.title("CSVデータ分析ツールv1.2")
 
 uploaded_file = st.file_uploader("CSVファイルを選んでください", type="csv")
 if uploaded_file is not None:
-    df = pd.read_csv(uploaded_file)
+    file_bytes = uploaded_file.getvalue()
+    file_digest = hashlib.sha256(file_bytes).hexdigest()
+    df = load_csv(file_bytes)
     if "terminal_date" not in df.columns:
         st.error("terminal_date列が見つかりません。CSVを確認してください。")
     else:
-        df["terminal_date"] = pd.to_datetime(df["terminal_date"])
         min_date = df["terminal_date"].min().date()
         max_date = df["terminal_date"].max().date()
         start_date = st.date_input("開始日", value=min_date, min_value=min_date, max_value=max_date)
@@ -184,4 +210,4 @@ if uploaded_file is not None:
             st.error("開始日は終了日より前にしてください。")
         else:
             if st.button("分析開始！"):
-                analyze_and_plot(df, pd.to_datetime(start_date), pd.to_datetime(end_date))
+                analyze_and_plot(df, file_digest, pd.to_datetime(start_date), pd.to_datetime(end_date))
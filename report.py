@@ -0,0 +1,126 @@
+import os
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.font_manager as fm
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+
+# app.py から分離した描画処理。画面表示とPDF出力で同じ描画関数を使う
+
+FONT_PATH = os.path.join(os.path.dirname(__file__), "ipaexg.ttf")
+
+# ===== PDF出力設定 =====
+# PDFはベクター出力。点数の多い散布図だけラスタ化し、その解像度をPDF_DPIとする
+PDF_DPI = 150
+RASTERIZE_MIN_POINTS = 100_000
+
+# ===== 時系列の間引き（LTTB） =====
+# 画面の解像度を超える点数は描画しても見えないため、形を保ったまま間引く
+LTTB_THRESHOLD = 3000
+LTTB_POINTS = 2000
+
+def lttb_indices(xn, y, n_out):
+    n = len(y)
+    if n <= n_out:
+        return np.arange(n)
+    if n_out < 3:
+        return np.unique([0, n - 1])
+
+    # 先頭・末尾を除いた点を n_out - 2 個のバケットに分け、各バケットから1点を選ぶ
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    idx = np.empty(n_out, dtype=int)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i == n_out - 3:
+            cx, cy = xn[-1], y[-1]
+        else:
+            cx, cy = xn[hi:edges[i + 2]].mean(), y[hi:edges[i + 2]].mean()
+        area = np.abs((xn[a] - cx) * (y[lo:hi] - y[a]) - (xn[a] - xn[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+def lttb(x, y, n_out=LTTB_POINTS):
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(y)
+    n_finite = int(finite.sum())
+    if n_finite <= n_out:
+        return x, y
+    xn = x.astype("datetime64[ns]").astype(np.int64) if np.issubdtype(x.dtype, np.datetime64) else x
+    xn = xn.astype(float)
+
+    # 1バケット幅以上続く欠損だけを区切りとし、区間の間にNaNを挟んで線の途切れを残す。
+    # それより短い欠損は画面上で見えないため、区間内では有限値だけを間引きの対象にする
+    n = len(y)
+    gap_min = -(-n // n_out)
+    nan_bounds = np.flatnonzero(np.diff(np.concatenate(([0], (~finite).astype(np.int8), [0]))))
+    nan_starts, nan_ends = nan_bounds[::2], nan_bounds[1::2]
+    wide = nan_ends - nan_starts >= gap_min
+    seg_starts = np.concatenate(([0], nan_ends[wide]))
+    seg_ends = np.concatenate((nan_starts[wide], [n]))
+
+    xs, ys = [], []
+    for start, end in zip(seg_starts, seg_ends):
+        sel = start + np.flatnonzero(finite[start:end])
+        if len(sel) == 0:
+            continue
+        if xs:
+            xs.append(x[sel[:1]])
+            ys.append(np.array([np.nan]))
+        # 各区間の点数は有限値の数に比例させ、合計がおよそn_outに収まるようにする
+        budget = n_out * len(sel) // n_finite
+        idx = sel[lttb_indices(xn[sel], y[sel], budget)]
+        xs.append(x[idx])
+        ys.append(y[idx])
+    return np.concatenate(xs), np.concatenate(ys)
+
+def downsample(x, y):
+    if len(y) > LTTB_THRESHOLD:
+        return lttb(x, y)
+    return x, y
+
+# ===== フォント登録 =====
+def register_font(font_path=FONT_PATH):
+    if not os.path.exists(font_path):
+        return False
+    fm.fontManager.addfont(font_path)
+    matplotlib.rcParams["font.family"] = fm.FontProperties(fname=font_path).get_name()
+    return True
+
+# ===== 共通描画関数 =====
+# spec は {"kind": "line" | "scatter", "x", "y", "title", "xlabel", "ylabel", ...} の辞書
+def draw_line(ax, spec):
+    x, y = spec["x"], spec["y"]
+    color = spec.get("color", "blue")
+    ax.plot(x, y, color=color, linewidth=spec.get("linewidth", 0.8), label="data")
+    ideal_range = spec.get("ideal_range")
+    if ideal_range:
+        ax.axhspan(ideal_range[0], ideal_range[1], color=color, alpha=0.1, label="ideal_range")
+
+def draw_scatter(ax, spec):
+    x, y = spec["x"], spec["y"]
+    ax.scatter(x, y, alpha=0.5, label="scatter", rasterized=len(x) >= RASTERIZE_MIN_POINTS)
+
+def draw(ax, spec):
+    ax.clear()
+    (draw_scatter if spec["kind"] == "scatter" else draw_line)(ax, spec)
+    ax.set_title(spec["title"])
+    ax.set_xlabel(spec["xlabel"])
+    ax.set_ylabel(spec["ylabel"])
+    ax.legend()
+    ax.tick_params(axis="x", labelrotation=90)
+
+# ===== PDF生成 =====
+# 1つのPdfPagesに書き込み、フォントの埋め込みを1回で済ませる
+def build_pdf(specs, out):
+    fig = Figure()
+    ax = fig.subplots()
+    with PdfPages(out) as pdf:
+        for spec in specs:
+            draw(ax, spec)
+            pdf.savefig(fig, bbox_inches="tight", dpi=PDF_DPI)